@@ -17,7 +17,7 @@
 
 """A Kubernetes charm for Grafana."""
 
-import configparser
+import functools
 import hashlib
 import json
 import logging
@@ -28,10 +28,8 @@ import socket
 import string
 import time
 from cosl import JujuTopology
-from io import StringIO
 from pathlib import Path
-from typing import Any, Callable, Dict, cast
-from urllib.parse import urlparse
+from typing import Any, Callable, Dict, List, Optional, Tuple, cast
 import subprocess
 
 import yaml
@@ -54,7 +52,7 @@ from charms.observability_libs.v0.kubernetes_compute_resources_patch import (
     ResourceRequirements,
     adjust_resource_requirements,
 )
-from charms.observability_libs.v0.cert_handler import CertHandler
+from charms.observability_libs.v0.cert_handler import CertChanged, CertHandler
 from charms.certificate_transfer_interface.v0.certificate_transfer import (
     CertificateAvailableEvent,
     CertificateRemovedEvent,
@@ -77,7 +75,7 @@ from charms.tempo_coordinator_k8s.v0.charm_tracing import trace_charm
 from charms.tempo_coordinator_k8s.v0.tracing import TracingEndpointRequirer, charm_tracing_config
 from ops.framework import StoredState
 from ops import main
-from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, Port
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, Port, Relation
 
 from ops.pebble import (
     APIError,
@@ -91,21 +89,29 @@ from ops.pebble import (
 
 from grafana_client import Grafana, GrafanaCommError
 
-logger = logging.getLogger()
+# Prefer the libyaml-backed emitter when PyYAML was built with it.
+try:
+    from yaml import CSafeDumper as _YamlDumper
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper as _YamlDumper  # type: ignore[assignment]
 
-REQUIRED_DATABASE_FIELDS = {
+logger = logging.getLogger(__name__)
+
+REQUIRED_DATABASE_FIELDS = (
     "type",  # mysql, postgres or sqlite3 (sqlite3 doesn't work for HA)
     "host",  # in the form '<url_or_ip>:<port>', e.g. 127.0.0.1:3306
     "name",
     "user",
     "password",
-}
+)
 
 VALID_DATABASE_TYPES = {"mysql", "postgres", "sqlite3"}
 VALID_AUTHENTICATION_MODES = {"proxy"}
 
 CONFIG_PATH = "/etc/grafana/grafana-config.ini"
 PROVISIONING_PATH = "/etc/grafana/provisioning"
+DASHBOARDS_DIR = PROVISIONING_PATH + "/dashboards"
+SELF_DASHBOARD_PATH = DASHBOARDS_DIR + "/self_dashboard.json"
 DATASOURCES_PATH = "/etc/grafana/provisioning/datasources/datasources.yaml"
 GRAFANA_CRT_PATH = "/etc/grafana/grafana.crt"
 GRAFANA_KEY_PATH = "/etc/grafana/grafana.key"
@@ -124,6 +130,36 @@ TRUSTED_CA_TEMPLATE = string.Template(
 # https://grafana.com/docs/grafana/latest/setup-grafana/configure-security/configure-authentication/generic-oauth
 OAUTH_SCOPES = "openid email offline_access"
 OAUTH_GRANT_TYPES = ["authorization_code", "refresh_token"]
+# Marks a value that has not been set yet, where None is a meaningful value
+_UNSET = object()
+
+
+def _new_digest():
+    """Return a fresh hash object for change detection and dashboard filenames.
+
+    None of these digests need to be cryptographically strong, so use BLAKE2b, which is
+    considerably faster than SHA-256 on CPUs without SHA extensions.
+    """
+    return hashlib.blake2b(digest_size=20)
+
+
+def _digest(content: bytes) -> str:
+    """Return a hex digest of ``content``, as built by :func:`_new_digest`."""
+    digest = _new_digest()
+    digest.update(content)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=4)
+def _compute_resource_reqs(cpu: Optional[str], memory: Optional[str]) -> ResourceRequirements:
+    """Compute the workload resource requirements for the given cpu and memory limits.
+
+    The result only depends on the two config options, so it is memoized to avoid re-running
+    the adjustment whenever the resource patch asks for it again.
+    """
+    limits = {"cpu": cpu, "memory": memory}
+    requests = {"cpu": "0.25", "memory": "200Mi"}
+    return adjust_resource_requirements(limits, requests, adhere_to_requests=True)
 
 
 @trace_charm(
@@ -161,15 +197,29 @@ class GrafanaCharm(CharmBase):
         }
         self._grafana_config_ini_hash = None
         self._grafana_datasources_hash = None
-        self._stored.set_default(admin_password="")
+        self._last_rendered_datasource_inputs: Optional[tuple] = None
+        self._last_config_inputs: Optional[tuple] = None
+        self._db_present: Optional[bool] = None
+        self._layer_cache: Optional[Tuple[tuple, Layer]] = None
+        self._peer_relation: Optional[Relation] = None
+        self._last_oauth_client_config: Optional[Tuple[OauthClientConfig, bool]] = None
+        self._resource_patch_ready_for: Optional[tuple] = None
+        self._trusted_ca_certs: Optional[Dict[str, str]] = None
+        self._last_installed_ca: object = _UNSET
+        # Assume dashboards may have been provisioned until a pass finds there are none
+        self._stored.set_default(admin_password="", dashboards_provisioned=True)
         self._topology = JujuTopology.from_charm(self)
+        # The FQDN is fixed for the life of a dispatch, and resolving it can mean a DNS lookup
+        self._fqdn = socket.getfqdn()
+        # Ingress routes and the external URL are namespaced by model and application
+        self._path_prefix = f"{self.model.name}-{self.model.app.name}"
 
         # -- cert_handler
         self.cert_handler = CertHandler(
             charm=self,
             key="grafana-server-cert",
             peer_relation_name="replicas",
-            extra_sans_dns=[socket.getfqdn()],
+            extra_sans_dns=[self._fqdn],
         )
 
         # -- trusted_cert_transfer
@@ -185,9 +235,6 @@ class GrafanaCharm(CharmBase):
         self.framework.observe(self.on.config_changed, self._configure_ingress)
         self.framework.observe(self.cert_handler.on.cert_changed, self._configure_ingress)
 
-        # Assuming FQDN is always part of the SANs DNS.
-        self.grafana_service = Grafana(f"{self._scheme}://{socket.getfqdn()}:{PORT}")
-
         self.metrics_endpoint = MetricsEndpointProvider(
             charm=self,
             jobs=self._metrics_scrape_jobs,
@@ -388,7 +435,11 @@ class GrafanaCharm(CharmBase):
         # None, so it overlaps a little with the above, but works as expected on leader elections
         # and config-change
         if self.ingress.is_ready():
-            self._configure()
+            # Config and cert changes are also observed by handlers that reconfigure Grafana
+            # themselves, so don't do the same work twice in one hook: _on_config_changed covers
+            # ConfigChangedEvent and _on_server_cert_changed covers CertChanged.
+            if not isinstance(event, (ConfigChangedEvent, CertChanged)):
+                self._configure()
             self.ingress.submit_to_traefik(self._ingress_config)
 
     def _configure_replication(self) -> None:
@@ -417,7 +468,11 @@ class GrafanaCharm(CharmBase):
 
         container = self.containers["replication"]
         if container.can_connect():
-            container.push("/etc/litestream.yml", yaml.dump(litestream_config), make_dirs=True)
+            container.push(
+                "/etc/litestream.yml",
+                yaml.dump(litestream_config, Dumper=_YamlDumper),
+                make_dirs=True,
+            )
 
         if restart:
             self.restart_litestream(leader)
@@ -440,35 +495,39 @@ class GrafanaCharm(CharmBase):
         If those are true, we have a Prometheus scraping this Grafana, and we should
         provision our dashboard.
         """
-        container = self.unit.get_container(self.name)
+        container = self.containers["workload"]
         if not container.can_connect():
             logger.warning("Cannot connect to Pebble yet, not provisioning own dashboard")
             return
 
-        source_related_apps = [rel.app for rel in self.model.relations["grafana-source"]]
-        scrape_related_apps = [rel.app for rel in self.model.relations["metrics-endpoint"]]
-
+        scrape_related_apps = {
+            rel.app for rel in self.model.relations["metrics-endpoint"] if rel.app
+        }
+        # Stop at the first source app that also scrapes us
         has_relation = any(
-            source for source in source_related_apps if source in scrape_related_apps
+            rel.app in scrape_related_apps for rel in self.model.relations["grafana-source"]
         )
 
-        dashboards_dir_path = os.path.join(PROVISIONING_PATH, "dashboards")
+        dashboards_dir_path = DASHBOARDS_DIR
         self.init_dashboard_provisioning(dashboards_dir_path)
 
-        dashboard_path = os.path.join(dashboards_dir_path, "self_dashboard.json")
+        dashboard_path = SELF_DASHBOARD_PATH
         if has_relation and self.unit.is_leader():
             # This is not going through the library due to the massive refactor needed in order
             # to squash all the `validate_relation_direction` and structure around smashing
             # the datastructures for a self-monitoring use case.
-            container.push(
-                dashboard_path, Path("src/self_dashboard.json").read_bytes(), make_dirs=True
-            )
+            with open("src/self_dashboard.json", "rb") as self_dashboard:
+                container.push(dashboard_path, self_dashboard, make_dirs=True)
         elif not has_relation or isinstance(event, RelationBrokenEvent):
             if container.list_files(dashboards_dir_path, pattern="self_dashboard.json"):
                 container.remove_path(dashboard_path)
                 logger.debug("Removed dashboard %s", dashboard_path)
                 self.restart_grafana()
 
+        # Provisioning does not reconfigure Grafana, so refresh the status and catalogue item
+        # here; the metrics-endpoint hooks reach no other _configure call.
+        self._configure()
+
     def _on_upgrade_charm(self, event: UpgradeCharmEvent) -> None:
         """Re-provision Grafana and its datasources on upgrade.
 
@@ -477,7 +536,7 @@ class GrafanaCharm(CharmBase):
         """
         self.source_consumer.upgrade_keys()
         self.dashboard_consumer.update_dashboards()
-        self._configure()
+        # This ends with a _configure pass, so there is no need for another one here
         self._on_dashboards_changed(event)
 
     def _on_stop(self, _) -> None:
@@ -486,15 +545,75 @@ class GrafanaCharm(CharmBase):
 
     def _check_datasource_provisioning(self) -> bool:
         """Check whether datasources need to be (re)provisioned."""
-        grafana_datasources = self._generate_datasource_config()
-        datasources_hash = hashlib.sha256(str(grafana_datasources).encode("utf-8")).hexdigest()
-        if not self.grafana_datasources_hash == datasources_hash:
-            self.grafana_datasources_hash = datasources_hash
-            self._update_datasource_config(grafana_datasources)
-            logger.info("Updated Grafana's datasource configuration")
+        # If nothing the datasource config is rendered from has changed since we last rendered
+        # it, skip the render, hash and push altogether.
+        datasource_inputs = self._datasource_inputs
+        if datasource_inputs == self._last_rendered_datasource_inputs:
+            return False
+
+        grafana_datasources = self._generate_datasource_config().encode("utf-8")
+        self._last_rendered_datasource_inputs = datasource_inputs
+        return self._sync_file(
+            grafana_datasources,
+            "grafana_datasources_hash",
+            self._update_datasource_config,
+            "datasource configuration",
+        )
 
-            return True
-        return False
+    def _sync_file(
+        self, content: bytes, hash_attr: str, push: Callable[[bytes], None], label: str
+    ) -> bool:
+        """Push a generated file to the workload if it differs from the one in place.
+
+        Args:
+            content: the encoded file content
+            hash_attr: name of the property holding the hash of the file in place
+            push: a callable writing the content to the workload container
+            label: what the file holds, for logging
+
+        Returns:
+            True if the file was updated, False if it was already up to date.
+        """
+        content_hash = _digest(content)
+        if getattr(self, hash_attr) == content_hash:
+            return False
+
+        setattr(self, hash_attr, content_hash)
+        push(content)
+        logger.info("Updated Grafana's %s", label)
+        return True
+
+    @property
+    def _config_inputs(self) -> tuple:
+        """Return a snapshot of everything the base Grafana config is generated from.
+
+        This covers the analytics setting, the database info in the peer application databag
+        and the tracing endpoint. Datasources are tracked separately, so a change to them does
+        not cause the base config to be rendered again.
+        """
+        peers = self.peers
+        tracing = self.workload_tracing
+        return (
+            self.model.config.get("reporting_enabled"),
+            peers.data[self.app].get("database", "") if peers else "",
+            self.has_db,
+            tracing.get_endpoint("otlp_grpc") if tracing.is_ready() else None,
+        )
+
+    @property
+    def _datasource_inputs(self) -> tuple:
+        """Return the raw inputs the datasource configuration is generated from.
+
+        The source consumer keeps its state in the peer relation, so the raw databag values
+        change whenever the sources (or the sources to delete) do.
+        """
+        peers = self.peers
+        peer_data = peers.data[self.app] if peers else {}
+        return (
+            peer_data.get("sources", ""),
+            peer_data.get("sources_to_delete", ""),
+            self.model.config.get("datasource_query_timeout"),
+        )
 
     def _configure(self, force_restart: bool = False) -> None:
         """Configure Grafana.
@@ -505,39 +624,52 @@ class GrafanaCharm(CharmBase):
 
         If ``force_restart``: restart grafana regardless.
         """
-        if not self.containers["workload"].can_connect():
+        container = self.containers["workload"]
+        if not container.can_connect():
             return
         logger.debug("Handling grafana-k8s configuration change")
         restart = force_restart
 
-        # Generate a new base config and see if it differs from what we have.
-        # If it does, store it and signal that we should restart Grafana
-        grafana_config_ini = self._generate_grafana_config()
-        config_ini_hash = hashlib.sha256(str(grafana_config_ini).encode("utf-8")).hexdigest()
-        if not self.grafana_config_ini_hash == config_ini_hash:
-            self.grafana_config_ini_hash = config_ini_hash
-            self._update_grafana_config_ini(grafana_config_ini)
-            logger.info("Updated Grafana's base configuration")
-
-            restart = True
-
-        self.oauth.update_client_config(client_config=self._oauth_client_config)
+        # Only regenerate the base config if something it is generated from has changed
+        # since we last wrote it.
+        config_inputs = self._config_inputs
+        if config_inputs != self._last_config_inputs:
+            # Generate a new base config and see if it differs from what we have.
+            # If it does, store it and signal that we should restart Grafana
+            if self._sync_file(
+                self._generate_grafana_config().encode("utf-8"),
+                "grafana_config_ini_hash",
+                self._update_grafana_config_ini,
+                "base configuration",
+            ):
+                restart = True
+            self._last_config_inputs = config_inputs
 
+        # The datasource check has its own input fingerprint
         if self._check_datasource_provisioning():
             # Non-leaders will get updates from litestream
             if self.unit.is_leader():
                 restart = True
 
-        if self.containers["workload"].get_plan().services != self._build_layer().services:
+        # The requirer validates and rewrites the relation data on every update, so only hand it
+        # a config it has not published yet. New relations get it from the requirer itself.
+        oauth_client_config = (self._oauth_client_config, self.unit.is_leader())
+        if oauth_client_config != self._last_oauth_client_config:
+            self.oauth.update_client_config(client_config=oauth_client_config[0])
+            self._last_oauth_client_config = oauth_client_config
+
+        # Build the layer once and hand it over to the restart, rather than rebuilding it there
+        layer = self._build_layer()
+        if container.get_plan().services != layer.services:
             restart = True
 
-        if not self.resource_patch.is_ready():
+        if not self._resource_patch_ready():
             if isinstance(self.unit.status, ActiveStatus) or self.unit.status.message == "":
                 self.unit.status = MaintenanceStatus("Waiting for resource limit patch to apply")
             return
 
         if restart:
-            self.restart_grafana()
+            self.restart_grafana(layer=layer)
         else:
             # All clear, move to active.
             # We can basically only get here if the charm is completely restarted, but all
@@ -550,13 +682,13 @@ class GrafanaCharm(CharmBase):
 
         self.catalog.update_item(item=self._catalogue_item)
 
-    def _update_datasource_config(self, config: str) -> None:
+    def _update_datasource_config(self, config: bytes) -> None:
         """Write an updated datasource configuration file to the Pebble container if necessary.
 
         Args:
-            config: A :str: containing the datasource configuration
+            config: A :bytes: containing the encoded datasource configuration
         """
-        container = self.unit.get_container(self.name)
+        container = self.containers["workload"]
 
         try:
             container.push(DATASOURCES_PATH, config, make_dirs=True)
@@ -565,11 +697,11 @@ class GrafanaCharm(CharmBase):
                 "Could not push datasource config. Pebble refused connection. Shutting down?"
             )
 
-    def _update_grafana_config_ini(self, config: str) -> None:
+    def _update_grafana_config_ini(self, config: bytes) -> None:
         """Write an updated Grafana configuration file to the Pebble container if necessary.
 
         Args:
-            config: A :str: containing the datasource configuration
+            config: A :bytes: containing the encoded Grafana configuration
         """
         try:
             self.containers["workload"].push(CONFIG_PATH, config, make_dirs=True)
@@ -581,24 +713,32 @@ class GrafanaCharm(CharmBase):
     @property
     def has_peers(self) -> bool:
         """Check whether there are any other Grafanas as peers."""
-        rel = self.model.get_relation(PEER)
+        rel = self.peers
         return len(rel.units) > 0 if rel is not None else False
 
     @property
     def peers(self):
-        """Fetch the peer relation."""
-        return self.model.get_relation(PEER)
+        """Fetch the peer relation.
+
+        The peer relation lives as long as the application once it is there, so it is only
+        looked up until it has been found.
+        """
+        if self._peer_relation is None:
+            self._peer_relation = self.model.get_relation(PEER)
+        return self._peer_relation
 
     def set_peer_data(self, key: str, data: Any) -> None:
         """Put information into the peer data bucket instead of `StoredState`."""
-        if self.peers:
-            self.peers.data[self.app][key] = json.dumps(data)
+        peers = self.peers
+        if peers:
+            peers.data[self.app][key] = json.dumps(data)
 
     def get_peer_data(self, key: str) -> Any:
         """Retrieve information from the peer data bucket instead of `StoredState`."""
-        if not self.peers:
+        peers = self.peers
+        if not peers:
             return {}
-        data = self.peers.data[self.app].get(key, "")
+        data = peers.data[self.app].get(key, "")
         return json.loads(data) if data else {}
 
     ############################
@@ -607,12 +747,14 @@ class GrafanaCharm(CharmBase):
     def init_dashboard_provisioning(self, dashboard_path: str):
         """Initialise the provisioning of Grafana dashboards.
 
+        This only writes the provider config and restarts Grafana if it changed; it does not
+        call `_configure`, so handlers that need the status refreshed must do so themselves.
+
         Args:
             dashboard_path: str; A file path to the dashboard to provision
         """
-        self._configure()
         logger.info("Initializing dashboard provisioning path")
-        container = self.unit.get_container(self.name)
+        container = self.containers["workload"]
 
         dashboard_config = {
             "apiVersion": 1,
@@ -626,24 +768,33 @@ class GrafanaCharm(CharmBase):
             ],
         }
 
-        default_config = os.path.join(dashboard_path, "default.yaml")
-        default_config_string = yaml.dump(dashboard_config)
+        default_config = f"{dashboard_path}/default.yaml"
+        default_config_string = yaml.dump(dashboard_config, Dumper=_YamlDumper)
 
-        if not os.path.exists(dashboard_path):
+        try:
+            # The provider config lives in the workload container, so look for it there. Dashboard
+            # files are picked up by the provider polling every updateIntervalSeconds (5s), so
+            # only a new provider config needs a restart.
             try:
+                current_config = container.pull(default_config).read()
+            except PathError:
+                current_config = None
+
+            if current_config != default_config_string:
                 container.push(default_config, default_config_string, make_dirs=True)
                 self.restart_grafana()
-            except ConnectionError:
-                logger.warning(
-                    "Could not push default dashboard configuration. Pebble shutting down?"
-                )
+        except ConnectionError:
+            logger.warning("Could not push default dashboard configuration. Pebble shutting down?")
 
     def _on_dashboards_changed(self, event) -> None:
         self._update_dashboards(event)
+        # Provisioning does not reconfigure Grafana, so refresh the status and catalogue item.
+        # This is cheap when nothing else changed.
+        self._configure()
 
     def _update_dashboards(self, event) -> None:
-        container = self.unit.get_container(self.name)
-        dashboards_dir_path = os.path.join(PROVISIONING_PATH, "dashboards")
+        container = self.containers["workload"]
+        dashboards_dir_path = DASHBOARDS_DIR
 
         self.init_dashboard_provisioning(dashboards_dir_path)
 
@@ -652,46 +803,48 @@ class GrafanaCharm(CharmBase):
             event.defer()
             return
 
-        dashboards_file_to_be_kept = {}
+        # Work out the desired set of dashboard files up front, so that only the files which are
+        # actually missing get pushed and only the stale ones get removed.
+        desired = {}
+        for dashboard in self.dashboard_consumer.dashboards:
+            dashboard_content = dashboard["content"]
+            # Only the digest needs the encoded bytes; missing dashboards are pushed as str,
+            # which ops encodes while streaming to Pebble.
+            dashboard_content_digest = _digest(dashboard_content.encode("utf-8"))
+            dashboard_filename = f"juju_{dashboard['charm']}_{dashboard_content_digest[:7]}.json"
+            desired[f"{dashboards_dir_path}/{dashboard_filename}"] = dashboard_content
+
+        # Nothing to push, and nothing left behind by an earlier pass to clean up
+        if not desired and not self._stored.dashboards_provisioned:
+            return
+
         try:
-            for dashboard_file in container.list_files(dashboards_dir_path, pattern="juju_*.json"):
-                dashboards_file_to_be_kept[dashboard_file.path] = False
-
-            for dashboard in self.dashboard_consumer.dashboards:
-                dashboard_content = dashboard["content"]
-                dashboard_content_bytes = dashboard_content.encode("utf-8")
-                dashboard_content_digest = hashlib.sha256(dashboard_content_bytes).hexdigest()
-                dashboard_filename = "juju_{}_{}.json".format(
-                    dashboard["charm"], dashboard_content_digest[0:7]
+            existing = {
+                dashboard_file.path
+                for dashboard_file in container.list_files(
+                    dashboards_dir_path, pattern="juju_*.json"
                 )
+            }
 
-                path = os.path.join(dashboards_dir_path, dashboard_filename)
-                dashboards_file_to_be_kept[path] = True
-
+            # The content digest is part of the filename, so an existing file is up to date
+            for path in desired.keys() - existing:
                 logger.debug("New dashboard %s", path)
-                container.push(path, dashboard_content_bytes, make_dirs=True)
+                container.push(path, desired[path], make_dirs=True)
 
-            for dashboard_file_path, to_be_kept in dashboards_file_to_be_kept.items():
-                if not to_be_kept:
-                    container.remove_path(dashboard_file_path)
-                    logger.debug("Removed dashboard %s", dashboard_file_path)
+            for path in existing - desired.keys():
+                container.remove_path(path)
+                logger.debug("Removed dashboard %s", path)
 
+            self._stored.dashboards_provisioned = bool(desired)
         except ConnectionError:
             logger.exception("Could not update dashboards. Pebble shutting down?")
 
     def set_ports(self):
         """Open necessary (and close no longer needed) workload ports."""
         planned_ports = {Port(protocol="tcp", port=PORT)} if self.unit.is_leader() else set()
-        actual_ports = self.unit.opened_ports()
-
-        # Ports may change across an upgrade, so need to sync
-        ports_to_close = actual_ports.difference(planned_ports)
-        for p in ports_to_close:
-            self.unit.close_port(p.protocol, p.port)
-
-        new_ports_to_open = planned_ports.difference(actual_ports)
-        for p in new_ports_to_open:
-            self.unit.open_port(p.protocol, p.port)
+        # Ports may change across an upgrade, so need to sync. This only opens and closes the
+        # ports which differ from the ones currently opened.
+        self.unit.set_ports(*planned_ports)
 
     #####################################
 
@@ -701,9 +854,15 @@ class GrafanaCharm(CharmBase):
 
     @property
     def has_db(self) -> bool:
-        """Only consider a DB connection if we have config info."""
-        rel = self.model.get_relation(DATABASE)
-        return len(rel.units) > 0 if rel is not None else False
+        """Only consider a DB connection if we have config info.
+
+        The relation lookup is done once and remembered; the database relation
+        handlers keep the cached value current.
+        """
+        if self._db_present is None:
+            rel = self.model.get_relation(DATABASE)
+            self._db_present = len(rel.units) > 0 if rel is not None else False
+        return self._db_present
 
     def _on_peer_data_changed(self, _: RelationChangedEvent) -> None:
         """Get the replica primary address from peer data so we can check whether to restart.
@@ -733,25 +892,31 @@ class GrafanaCharm(CharmBase):
         Args:
             event: A :class:`RelationChangedEvent` from a `database` source
         """
+        # Membership may have changed; look it up again on next access.
+        self._db_present = None
         if not self.unit.is_leader():
             return
 
         # Get required information
-        database_fields = {
-            field: event.relation.data[event.app].get(field) for field in REQUIRED_DATABASE_FIELDS  # type: ignore
-        }
+        app_data = event.relation.data[event.app]  # type: ignore
+        db_info: Dict[str, str] = {}
+        missing_fields: List[str] = []
+        for field in REQUIRED_DATABASE_FIELDS:
+            value = app_data.get(field)
+            if value is None:
+                missing_fields.append(field)
+            elif value:
+                db_info[field] = value
 
         # if any required fields are missing, warn the user and return
-        missing_fields = [
-            field for field in REQUIRED_DATABASE_FIELDS if database_fields.get(field) is None
-        ]
-        if len(missing_fields) > 0:
+        if missing_fields:
             raise SourceFieldsMissingError(
                 "Missing required data fields for database relation: {}".format(missing_fields)
             )
 
-        # add the new database relation data to the datastore
-        db_info = {field: value for field, value in database_fields.items() if value}
+        self._db_present = True
+        # add the new database relation data to the datastore. Unchanged fields leave the
+        # databag as is, and _configure skips regenerating the config when its inputs match.
         self.set_peer_data("database", db_info)
 
         self._configure()
@@ -766,6 +931,7 @@ class GrafanaCharm(CharmBase):
         Args:
             event: a :class:`RelationBrokenEvent` from a `database` source
         """
+        self._db_present = False
         if not self.unit.is_leader():
             return
 
@@ -803,15 +969,7 @@ class GrafanaCharm(CharmBase):
         if self.has_db:
             configs.append(self._generate_database_config())
         else:
-            with StringIO() as data:
-                config_ini = configparser.ConfigParser()
-                config_ini["database"] = {
-                    "type": "sqlite3",
-                    "path": DATABASE_PATH,
-                }
-                config_ini.write(data)
-                data.seek(0)
-                configs.append(data.read())
+            configs.append(f"[database]\ntype = sqlite3\npath = {DATABASE_PATH}\n\n")
 
         return "\n".join(filter(bool, configs))
 
@@ -829,22 +987,16 @@ class GrafanaCharm(CharmBase):
         if endpoint is None:
             return ""
 
-        config_ini = configparser.ConfigParser()
-        config_ini["tracing.opentelemetry"] = {
-            "sampler_type": "probabilistic",
-            "sampler_param": "0.01",
-        }
         # ref: https://github.com/grafana/grafana/blob/main/conf/defaults.ini#L1505
-        config_ini["tracing.opentelemetry.otlp"] = {
-            "address": endpoint,
-        }
-
-        # This is silly, but a ConfigParser() handles this nicer than
-        # raw string manipulation
-        data = StringIO()
-        config_ini.write(data)
-        ret = data.getvalue()
-        return ret
+        return (
+            "[tracing.opentelemetry]\n"
+            "sampler_type = probabilistic\n"
+            "sampler_param = 0.01\n"
+            "\n"
+            "[tracing.opentelemetry.otlp]\n"
+            f"address = {endpoint}\n"
+            "\n"
+        )
 
     def _generate_analytics_config(self) -> str:
         """Generate analytics configuration.
@@ -854,18 +1006,14 @@ class GrafanaCharm(CharmBase):
         """
         if self.config["reporting_enabled"]:
             return ""
-        config_ini = configparser.ConfigParser()
         # Ref: https://grafana.com/docs/grafana/latest/setup-grafana/configure-grafana/#analytics
-        config_ini["analytics"] = {
-            "reporting_enabled": "false",
-            "check_for_updates": "false",
-            "check_for_plugin_updates": "false",
-        }
-
-        data = StringIO()
-        config_ini.write(data)
-        ret = data.getvalue()
-        return ret
+        return (
+            "[analytics]\n"
+            "reporting_enabled = false\n"
+            "check_for_updates = false\n"
+            "check_for_plugin_updates = false\n"
+            "\n"
+        )
 
     def _generate_database_config(self) -> str:
         """Generate a database configuration.
@@ -878,30 +1026,25 @@ class GrafanaCharm(CharmBase):
         if not db_config:
             return ""
 
-        config_ini = configparser.ConfigParser()
         db_type = "mysql"
 
-        db_url = "{0}://{1}:{2}@{3}/{4}".format(
-            db_type,
-            db_config.get("user"),
-            db_config.get("password"),
-            db_config.get("host"),
-            db_config.get("name"),
+        db_url = (
+            f"{db_type}://{db_config.get('user')}:{db_config.get('password')}"
+            f"@{db_config.get('host')}/{db_config.get('name')}"
         )
-        config_ini["database"] = {
-            "type": db_type,
-            "host": db_config.get("host"),
-            "name": db_config.get("name", ""),
-            "user": db_config.get("user", ""),
-            "password": db_config.get("password", ""),
-            "url": db_url,
-        }
 
-        # This is still silly
-        data = StringIO()
-        config_ini.write(data)
-        ret = data.getvalue()
-        return ret
+        # The section has a fixed shape, so emit it directly in the same layout ConfigParser
+        # would write it in
+        return (
+            "[database]\n"
+            f"type = {db_type}\n"
+            f"host = {db_config.get('host', '')}\n"
+            f"name = {db_config.get('name', '')}\n"
+            f"user = {db_config.get('user', '')}\n"
+            f"password = {db_config.get('password', '')}\n"
+            f"url = {db_url}\n"
+            "\n"
+        )
 
     #####################################
 
@@ -911,9 +1054,9 @@ class GrafanaCharm(CharmBase):
 
     def _on_pebble_ready(self, event) -> None:
         """When Pebble is ready, start everything up."""
-        self._configure()
         self.source_consumer.upgrade_keys()
         self.dashboard_consumer.update_dashboards()
+        self._configure()
         self._update_dashboards(event)
 
         # Create provisioning subfolders to avoid errors on startup
@@ -943,7 +1086,7 @@ class GrafanaCharm(CharmBase):
             and workload.exists(GRAFANA_KEY_PATH)
         )
 
-    def restart_grafana(self) -> None:
+    def restart_grafana(self, layer: Optional[Layer] = None) -> None:
         """Restart the pebble container.
 
         `container.replan()` is intentionally avoided, since if no environment
@@ -951,6 +1094,9 @@ class GrafanaCharm(CharmBase):
         necessary to reload the provisioning files.
 
         Note that Grafana does not support SIGHUP, so a full restart is needed.
+
+        Args:
+            layer: an already built grafana :class:`Layer`; built afresh if not given.
         """
         # Before building the layer, we update our certificates if tls is enabled.
         # This is needed here to circumvent a code ordering issue that results in:
@@ -966,20 +1112,20 @@ class GrafanaCharm(CharmBase):
         # we do this here, downstream from a container readiness check
         self._update_trusted_ca_certs()
 
-        layer = self._build_layer()
+        if layer is None:
+            layer = self._build_layer()
+        container = self.containers["workload"]
         try:
-            self.containers["workload"].add_layer(self.name, layer, combine=True)
-            if self.containers["workload"].get_service(self.name).is_running():
-                self.containers["workload"].stop(self.name)
-
-            self.containers["workload"].start(self.name)
+            container.add_layer(self.name, layer, combine=True)
+            # Stops the service first if it is running, starts it otherwise
+            container.restart(self.name)
             logger.info("Restarted grafana-k8s")
 
-            if self._poll_container(self.containers["workload"].can_connect):
+            if self._poll_container(container.can_connect):
                 # We should also make sure sqlite is in WAL mode for replication
                 self._push_sqlite_static()
 
-                pragma = self.containers["workload"].exec(
+                pragma = container.exec(
                     [
                         "/usr/local/bin/sqlite3",
                         DATABASE_PATH,
@@ -992,7 +1138,7 @@ class GrafanaCharm(CharmBase):
         except ExecError as e:
             # debug because, on initial container startup when Grafana has an open lock and is
             # populating, this comes up with ERRCODE: 26
-            logger.debug("Could not apply journal_mode pragma. Exit code: {}".format(e.exit_code))
+            logger.debug("Could not apply journal_mode pragma. Exit code: %s", e.exit_code)
         except ConnectionError:
             logger.error(
                 "Could not restart grafana-k8s -- Pebble socket does "
@@ -1029,6 +1175,9 @@ class GrafanaCharm(CharmBase):
 
         Ref: https://github.com/grafana/grafana/blob/main/conf/defaults.ini
         """
+        config = self.model.config
+        # The scheme is looked up from the certificate handler, so only do that once
+        scheme = self._scheme
         # Placeholder for when we add "proper" mysql support for HA
         extra_info = {
             "GF_DATABASE_TYPE": "sqlite3",
@@ -1043,8 +1192,8 @@ class GrafanaCharm(CharmBase):
             }
         )
 
-        if self._auth_env_vars:
-            extra_info.update(self._auth_env_vars)
+        if auth_env_vars := self._auth_env_vars:
+            extra_info.update(auth_env_vars)
 
         # For stripPrefix middleware to work correctly, we need to set serve_from_sub_path and
         # root_url in a particular way.
@@ -1057,7 +1206,7 @@ class GrafanaCharm(CharmBase):
                 # When traefik provides TLS termination then traefik is https, but grafana is http.
                 # We need to set GF_SERVER_PROTOCOL.
                 # https://grafana.com/tutorials/run-grafana-behind-a-proxy/#1
-                "GF_SERVER_PROTOCOL": self._scheme,
+                "GF_SERVER_PROTOCOL": scheme,
             }
         )
 
@@ -1067,7 +1216,7 @@ class GrafanaCharm(CharmBase):
         # returned over relation data, go to peer data, and eventually be written to disk). When
         # grafana is restarted in HTTPS mode but without certs in place, we'll see a brief error:
         # "error: cert_file cannot be empty when using HTTPS".
-        if self._scheme == "https":
+        if scheme == "https":
             extra_info.update(
                 {
                     "GF_SERVER_CERT_KEY": GRAFANA_KEY_PATH,
@@ -1097,13 +1246,7 @@ class GrafanaCharm(CharmBase):
             )
 
         if self.workload_tracing.is_ready():
-            topology = self._topology
-            extra_info.update(
-                {
-                    "OTEL_RESOURCE_ATTRIBUTES": f"juju_application={topology.application},juju_model={topology.model}"
-                    + f",juju_model_uuid={topology.model_uuid},juju_unit={topology.unit},juju_charm={topology.charm_name}",
-                }
-            )
+            extra_info["OTEL_RESOURCE_ATTRIBUTES"] = self._otel_resource_attributes
 
         # if we have any profiling relations, switch on profiling
         if self.model.relations.get("profiling-endpoint"):
@@ -1116,6 +1259,25 @@ class GrafanaCharm(CharmBase):
                 }
             )
 
+        environment = {
+            "GF_SERVER_HTTP_PORT": str(PORT),
+            "GF_LOG_LEVEL": cast(str, config["log_level"]),
+            "GF_PLUGINS_ENABLE_ALPHA": "true",
+            "GF_PATHS_PROVISIONING": PROVISIONING_PATH,
+            "GF_SECURITY_ALLOW_EMBEDDING": cast(str, config["allow_embedding"]),
+            "GF_SECURITY_ADMIN_USER": cast(str, config["admin_user"]),
+            "GF_SECURITY_ADMIN_PASSWORD": self._get_admin_password(),
+            "GF_AUTH_ANONYMOUS_ENABLED": cast(str, config["allow_anonymous_access"]),
+            "GF_USERS_AUTO_ASSIGN_ORG": str(config["enable_auto_assign_org"]),
+            **extra_info,
+        }
+
+        # The environment is the only part of the layer that varies, so reuse the last
+        # layer built from an identical one.
+        cache_key = tuple(sorted(environment.items()))
+        if self._layer_cache is not None and self._layer_cache[0] == cache_key:
+            return self._layer_cache[1]
+
         layer = Layer(
             {
                 "summary": "grafana-k8s layer",
@@ -1124,46 +1286,41 @@ class GrafanaCharm(CharmBase):
                     self.name: {
                         "override": "replace",
                         "summary": "grafana-k8s service",
-                        "command": "grafana-server -config {}".format(CONFIG_PATH),
+                        "command": f"grafana-server -config {CONFIG_PATH}",
                         "startup": "enabled",
-                        "environment": {
-                            "GF_SERVER_HTTP_PORT": str(PORT),
-                            "GF_LOG_LEVEL": cast(str, self.model.config["log_level"]),
-                            "GF_PLUGINS_ENABLE_ALPHA": "true",
-                            "GF_PATHS_PROVISIONING": PROVISIONING_PATH,
-                            "GF_SECURITY_ALLOW_EMBEDDING": cast(
-                                str, self.model.config["allow_embedding"]
-                            ),
-                            "GF_SECURITY_ADMIN_USER": cast(str, self.model.config["admin_user"]),
-                            "GF_SECURITY_ADMIN_PASSWORD": self._get_admin_password(),
-                            "GF_AUTH_ANONYMOUS_ENABLED": cast(
-                                str, self.model.config["allow_anonymous_access"]
-                            ),
-                            "GF_USERS_AUTO_ASSIGN_ORG": str(
-                                self.model.config["enable_auto_assign_org"]
-                            ),
-                            **extra_info,
-                        },
+                        "environment": environment,
                     }
                 },
             }
         )
+        self._layer_cache = (cache_key, layer)
 
         return layer
 
+    @functools.cached_property
+    def _otel_resource_attributes(self) -> str:
+        """The juju topology as OTEL resource attributes, for the workload traces."""
+        topology = self._topology
+        return ",".join(
+            [
+                f"juju_application={topology.application}",
+                f"juju_model={topology.model}",
+                f"juju_model_uuid={topology.model_uuid}",
+                f"juju_unit={topology.unit}",
+                f"juju_charm={topology.charm_name}",
+            ]
+        )
+
     def _build_replication(self, primary: bool) -> Layer:
         """Construct the pebble layer information for litestream."""
         config = {}
 
         if primary:
-            self.set_peer_data("replica_primary", socket.gethostbyname(socket.getfqdn()))
-            config["LITESTREAM_ADDR"] = "{}:{}".format(
-                socket.gethostbyname(socket.getfqdn()), "9876"
-            )
+            address = socket.gethostbyname(self._fqdn)
+            self.set_peer_data("replica_primary", address)
+            config["LITESTREAM_ADDR"] = f"{address}:9876"
         else:
-            config["LITESTREAM_UPSTREAM_URL"] = "{}:{}".format(
-                self.get_peer_data("replica_primary"), "9876"
-            )
+            config["LITESTREAM_UPSTREAM_URL"] = f"{self.get_peer_data('replica_primary')}:9876"
 
         layer = Layer(
             {
@@ -1229,20 +1386,30 @@ class GrafanaCharm(CharmBase):
         Args:
             file: a `str` filepath to read
         """
-        if self.containers["workload"].can_connect():
-            try:
-                content = self.containers["workload"].pull(file)
-                hash = hashlib.sha256(str(content.read()).encode("utf-8")).hexdigest()
-                return hash
-            except (FileNotFoundError, ProtocolError, PathError) as e:
-                logger.warning(
-                    "Could not read configuration from the Grafana workload container: {}".format(
-                        e
-                    )
-                )
+        container = self.containers["workload"]
+        if not container.can_connect():
+            return ""
+
+        try:
+            # Hash the raw bytes in chunks rather than decoding the whole file first
+            content = container.pull(file, encoding=None)
+            digest = _new_digest()
+            for chunk in iter(lambda: content.read(65536), b""):
+                digest.update(chunk)
+            return digest.hexdigest()
+        except (FileNotFoundError, ProtocolError, PathError) as e:
+            logger.warning(
+                "Could not read configuration from the Grafana workload container: %s", e
+            )
 
         return ""
 
+    @functools.cached_property
+    def grafana_service(self) -> Grafana:
+        """A client for the Grafana API, only set up once something talks to Grafana."""
+        # Assuming FQDN is always part of the SANs DNS.
+        return Grafana(f"{self._scheme}://{self._fqdn}:{PORT}")
+
     @property
     def build_info(self) -> dict:
         """Returns information about the running Grafana service."""
@@ -1259,8 +1426,11 @@ class GrafanaCharm(CharmBase):
         """
         # Boilerplate for the config file
         datasources_dict = {"apiVersion": 1, "datasources": [], "deleteDatasources": []}
+        configured_timeout = int(self.model.config.get("datasource_query_timeout", 0))
 
-        for source_info in self.source_consumer.sources:
+        # Sort both lists, so the same sources always render to the same file (and hash)
+        sources = sorted(self.source_consumer.sources, key=lambda source: source["source_name"])
+        for source_info in sources:
             source = {
                 "orgId": "1",
                 "access": "proxy",
@@ -1269,27 +1439,23 @@ class GrafanaCharm(CharmBase):
                 "type": source_info["source_type"],
                 "url": source_info["url"],
             }
-            if source_info.get("extra_fields", None):
-                source["jsonData"] = source_info.get("extra_fields")
-            if source_info.get("secure_extra_fields", None):
-                source["secureJsonData"] = source_info.get("secure_extra_fields")
-
+            json_data = dict(source_info.get("extra_fields") or {})
             # set timeout for querying this data source
-            timeout = int(source.get("jsonData", {}).get("timeout", 0))
-            configured_timeout = int(self.model.config.get("datasource_query_timeout", 0))
-            if timeout < configured_timeout:
-                json_data = source.get("jsonData", {})
-                json_data.update({"timeout": configured_timeout})
+            if int(json_data.get("timeout", 0)) < configured_timeout:
+                json_data["timeout"] = configured_timeout
+            if json_data:
                 source["jsonData"] = json_data
+            if source_info.get("secure_extra_fields", None):
+                source["secureJsonData"] = source_info.get("secure_extra_fields")
 
             datasources_dict["datasources"].append(source)  # type: ignore[attr-defined]
 
         # Also get a list of all the sources which have previously been purged and add them
-        for name in self.source_consumer.sources_to_delete:
+        for name in sorted(self.source_consumer.sources_to_delete):
             source = {"orgId": 1, "name": name}
             datasources_dict["deleteDatasources"].append(source)  # type: ignore[attr-defined]
 
-        datasources_string = yaml.dump(datasources_dict)
+        datasources_string = yaml.dump(datasources_dict, Dumper=_YamlDumper)
         return datasources_string
 
     def _on_get_admin_password(self, event: ActionEvent) -> None:
@@ -1336,7 +1502,10 @@ class GrafanaCharm(CharmBase):
             # envvar is the authoritative source for the admin password (just in case something
             # went wrong with stored state; we need a single source of truth at all times).
             if pw := svc.environment.get("GF_SECURITY_ADMIN_PASSWORD"):
-                self._stored.admin_password = pw
+                # Any assignment marks stored state dirty, which costs a write to the controller
+                # at the end of the hook, so only assign when the password actually differs.
+                if pw != self._stored.admin_password:
+                    self._stored.admin_password = pw
             else:
                 # For some reason the password is blank. Generate one if it's not in stored state.
                 self._generate_admin_password()
@@ -1376,12 +1545,34 @@ class GrafanaCharm(CharmBase):
         # Really limited by what can be passed into shell commands, since this all goes
         # through subprocess. So much for complex password
         chars = string.ascii_letters + string.digits
-        return "".join(secrets.choice(chars) for _ in range(12))
+        # Draw all the randomness in one go and spell it out in base 62, rather than going
+        # back to the system RNG for every character
+        value = secrets.randbelow(len(chars) ** 12)
+        password = []
+        for _ in range(12):
+            value, index = divmod(value, len(chars))
+            password.append(chars[index])
+        return "".join(password)
 
     def _resource_reqs_from_config(self) -> ResourceRequirements:
-        limits = {"cpu": self.model.config.get("cpu"), "memory": self.model.config.get("memory")}
-        requests = {"cpu": "0.25", "memory": "200Mi"}
-        return adjust_resource_requirements(limits, requests, adhere_to_requests=True)
+        return _compute_resource_reqs(
+            cast(Optional[str], self.model.config.get("cpu")),
+            cast(Optional[str], self.model.config.get("memory")),
+        )
+
+    def _resource_patch_ready(self) -> bool:
+        """Return whether the resource patch is in effect, querying Kubernetes at most once.
+
+        Once the patch is in effect it stays so for the current limits, so later reconciles in
+        the same dispatch reuse the answer until the ``cpu`` or ``memory`` options change.
+        """
+        limits = (self.model.config.get("cpu"), self.model.config.get("memory"))
+        if self._resource_patch_ready_for == limits:
+            return True
+        if not self.resource_patch.is_ready():
+            return False
+        self._resource_patch_ready_for = limits
+        return True
 
     def _on_resource_patch_failed(self, event: K8sResourcePatchFailedEvent):
         self.unit.status = BlockedStatus(str(event.message))
@@ -1393,28 +1584,29 @@ class GrafanaCharm(CharmBase):
     @property
     def internal_url(self) -> str:
         """Return workload's internal URL. Used for ingress."""
-        return f"{self._scheme}://{socket.getfqdn()}:{PORT}"
+        return f"{self._scheme}://{self._fqdn}:{PORT}"
 
     @property
     def external_url(self) -> str:
         """Return the external hostname configured, if any."""
-        if self.ingress.external_host:
-            path_prefix = f"{self.model.name}-{self.model.app.name}"
+        # Every read of the ingress data re-syncs the lib's stored state, so only read it once
+        if external_host := self.ingress.external_host:
             # The scheme we use here needs to be the ingress URL's scheme:
             # If traefik is providing TLS termination then the ingress scheme is https, but
             # grafana's scheme is still http.
-            return f"{self.ingress.scheme or 'http'}://{self.ingress.external_host}/{path_prefix}"
+            return f"{self.ingress.scheme or 'http'}://{external_host}/{self._path_prefix}"
         return self.internal_url
 
     @property
     def _ingress_config(self) -> dict:
         """Build a raw ingress configuration for Traefik."""
         # The path prefix is the same as in ingress per app
-        external_path = f"{self.model.name}-{self.model.app.name}"
+        external_path = self._path_prefix
+        external_host = self.ingress.external_host
 
         redirect_middleware = (
             {
-                f"juju-sidecar-redir-https-{self.model.name}-{self.model.app.name}": {
+                f"juju-sidecar-redir-https-{external_path}": {
                     "redirectScheme": {
                         "permanent": True,
                         "port": 443,
@@ -1427,40 +1619,37 @@ class GrafanaCharm(CharmBase):
         )
 
         middlewares = {
-            f"juju-sidecar-noprefix-{self.model.name}-{self.model.app.name}": {
+            f"juju-sidecar-noprefix-{external_path}": {
                 "stripPrefix": {"forceSlash": False, "prefixes": [f"/{external_path}"]},
             },
             **redirect_middleware,
         }
 
+        service = f"juju-{external_path}-service"
         routers = {
-            "juju-{}-{}-router".format(self.model.name, self.model.app.name): {
+            f"juju-{external_path}-router": {
                 "entryPoints": ["web"],
                 "rule": f"PathPrefix(`/{external_path}`)",
                 "middlewares": list(middlewares.keys()),
-                "service": "juju-{}-{}-service".format(self.model.name, self.app.name),
+                "service": service,
             },
-            "juju-{}-{}-router-tls".format(self.model.name, self.model.app.name): {
+            f"juju-{external_path}-router-tls": {
                 "entryPoints": ["websecure"],
                 "rule": f"PathPrefix(`/{external_path}`)",
                 "middlewares": list(middlewares.keys()),
-                "service": "juju-{}-{}-service".format(self.model.name, self.app.name),
+                "service": service,
                 "tls": {
                     "domains": [
                         {
-                            "main": self.ingress.external_host,
-                            "sans": [f"*.{self.ingress.external_host}"],
+                            "main": external_host,
+                            "sans": [f"*.{external_host}"],
                         },
                     ],
                 },
             },
         }
 
-        services = {
-            "juju-{}-{}-service".format(self.model.name, self.model.app.name): {
-                "loadBalancer": {"servers": [{"url": self.internal_url}]}
-            }
-        }
+        services = {service: {"loadBalancer": {"servers": [{"url": self.internal_url}]}}}
 
         return {"http": {"routers": routers, "services": services, "middlewares": middlewares}}
 
@@ -1497,18 +1686,19 @@ class GrafanaCharm(CharmBase):
         if auth_mode not in VALID_AUTHENTICATION_MODES:
             logger.warning("Invalid authentication mode")
             return {}
-        env_vars = {}
-        auth_var_prefix = "GF_AUTH_" + auth_mode.upper() + "_"
-        mode_enabled_var = auth_var_prefix + "ENABLED"
-        env_vars[mode_enabled_var] = "True"
-        for var in conf[auth_mode].keys():
-            env_vars[auth_var_prefix + str(var).upper()] = str(conf[auth_mode][var])
-        return env_vars
+        auth_var_prefix = f"GF_AUTH_{auth_mode.upper()}_"
+        # The config comes from JSON, so its keys are always strings
+        return {
+            f"{auth_var_prefix}ENABLED": "True",
+            **{
+                f"{auth_var_prefix}{var.upper()}": str(value)
+                for var, value in conf[auth_mode].items()
+            },
+        }
 
     @property
     def _metrics_scrape_jobs(self) -> list:
-        parts = urlparse(self.internal_url)
-        job = {"static_configs": [{"targets": [parts.netloc]}], "scheme": self._scheme}
+        job = {"static_configs": [{"targets": [f"{self._fqdn}:{PORT}"]}], "scheme": self._scheme}
         return [job]
 
     @property
@@ -1541,24 +1731,46 @@ class GrafanaCharm(CharmBase):
         else:
             container.remove_path(GRAFANA_KEY_PATH, recursive=True)
 
-        if self.cert_handler.ca:
+        # Restarts can happen more than once per hook; the workload trust store only needs
+        # rebuilding once for a given CA.
+        ca = self.cert_handler.ca
+        if ca == self._last_installed_ca:
+            return
+
+        # The charm container keeps its filesystem across hooks, so its trust store only needs
+        # rebuilding when the CA file there actually changes.
+        charm_ca_changed = False
+        if ca:
             # Save the CA among the trusted CAs and trust it
             container.push(
                 CA_CERT_PATH,
-                self.cert_handler.ca,
+                ca,
                 make_dirs=True,
             )
 
             # Repeat for the charm container. We need it there for grafana client requests.
-            CA_CERT_PATH.parent.mkdir(exist_ok=True, parents=True)
-            CA_CERT_PATH.write_text(self.cert_handler.ca)
+            if not CA_CERT_PATH.exists() or CA_CERT_PATH.read_text() != ca:
+                CA_CERT_PATH.parent.mkdir(exist_ok=True, parents=True)
+                # Swap the file in whole, so the trust store never sees a partly written CA.
+                # The temporary file lacks the .crt suffix update-ca-certificates looks for.
+                tmp_path = CA_CERT_PATH.with_suffix(".new")
+                try:
+                    tmp_path.write_text(ca)
+                    os.replace(tmp_path, CA_CERT_PATH)
+                finally:
+                    tmp_path.unlink(missing_ok=True)
+                charm_ca_changed = True
         else:
             container.remove_path(CA_CERT_PATH, recursive=True)
             # Repeat for the charm container.
-            CA_CERT_PATH.unlink(missing_ok=True)
+            if CA_CERT_PATH.exists():
+                CA_CERT_PATH.unlink()
+                charm_ca_changed = True
 
         container.exec(["update-ca-certificates", "--fresh"]).wait()
-        subprocess.run(["update-ca-certificates", "--fresh"])
+        if charm_ca_changed:
+            subprocess.run(["update-ca-certificates", "--fresh"])
+        self._last_installed_ca = ca
 
     def _on_trusted_certificate_available(self, event: CertificateAvailableEvent):
         if not self.containers["workload"].can_connect():
@@ -1576,30 +1788,52 @@ class GrafanaCharm(CharmBase):
         This function is needed because relation events are not emitted on upgrade, and because we
         do not have (nor do we want) persistent storage for certs.
         """
-        if not self.model.get_relation(relation_name=self.trusted_cert_transfer.relationship_name):
+        relations = self.model.relations.get(self.trusted_cert_transfer.relationship_name)
+        if not relations:
             return
 
         logger.info(
             "Pulling trusted ca certificates from %s relation.",
             self.trusted_cert_transfer.relationship_name,
         )
-        container = self.containers["workload"]
-        for relation in self.model.relations.get(self.trusted_cert_transfer.relationship_name, []):
-            # For some reason, relation.units includes our unit and app. Need to exclude them.
-            for unit in set(relation.units).difference([self.app, self.unit]):
+        # For some reason, relation.units includes our unit and app. Need to exclude them.
+        ourselves = (self.app, self.unit)
+        certs: Dict[str, str] = {}
+        for relation in relations:
+            cert_path = TRUSTED_CA_TEMPLATE.substitute(rel_id=relation.id)
+            for unit in relation.units:
+                if unit in ourselves:
+                    continue
                 # Note: this nested loop handles the case of multi-unit CA, each unit providing
                 # a different ca cert, but that is not currently supported by the lib itself.
-                cert_path = TRUSTED_CA_TEMPLATE.substitute(rel_id=relation.id)
                 if cert := relation.data[unit].get("ca"):
-                    container.push(cert_path, cert, make_dirs=True)
+                    certs[cert_path] = cert
+
+        # Both pebble-ready and every restart get here, so skip redoing the same work twice
+        # in a dispatch.
+        if certs == self._trusted_ca_certs:
+            return
+
+        container = self.containers["workload"]
+        for cert_path, cert in certs.items():
+            container.push(cert_path, cert, make_dirs=True)
 
         container.exec(["update-ca-certificates", "--fresh"]).wait()
+        self._trusted_ca_certs = certs
 
     def _on_trusted_certificate_removed(self, event: CertificateRemovedEvent):
         # All certificates received from the relation are in separate files marked by the relation id.
         container = self.containers["workload"]
         cert_path = TRUSTED_CA_TEMPLATE.substitute(rel_id=event.relation_id)
         container.remove_path(cert_path, recursive=True)
+        if self.model.relations.get(self.trusted_cert_transfer.relationship_name):
+            # restart_grafana goes through _update_trusted_ca_certs, which rebuilds the trust
+            # store from the remaining relations once the cached set is dropped.
+            self._trusted_ca_certs = None
+        else:
+            # No relation is left for _update_trusted_ca_certs to act on, so drop the CA here.
+            container.exec(["update-ca-certificates", "--fresh"]).wait()
+            self._trusted_ca_certs = {}
         self.restart_grafana()
 
     @property
@@ -1616,12 +1850,14 @@ class GrafanaCharm(CharmBase):
 
     def _push_sqlite_static(self):
         # for ease of mocking in unittests, this is a standalone function
-        self.containers["workload"].push(
-            "/usr/local/bin/sqlite3",
-            Path("sqlite-static").read_bytes(),
-            permissions=0o755,
-            make_dirs=True,
-        )
+        # The binary is several MB, so stream it to Pebble instead of reading it into memory
+        with open("sqlite-static", "rb") as sqlite_static:
+            self.containers["workload"].push(
+                "/usr/local/bin/sqlite3",
+                sqlite_static,
+                permissions=0o755,
+                make_dirs=True,
+            )
 
 
 if __name__ == "__main__":
@@ -3,12 +3,22 @@
 
 import hashlib
 import json
+import os
 import re
+import tempfile
 import unittest
+from pathlib import Path
 from unittest.mock import MagicMock, PropertyMock, patch
 
 import ops
 import yaml
+from charms.grafana_k8s.v0.grafana_dashboard import GrafanaDashboardConsumer
+from charms.grafana_k8s.v0.grafana_source import GrafanaSourceConsumer
+from charms.observability_libs.v0.cert_handler import CertHandler
+from charms.observability_libs.v0.kubernetes_compute_resources_patch import (
+    KubernetesComputeResourcesPatch,
+)
+from charms.traefik_k8s.v0.traefik_route import TraefikRouteRequirer
 from ops.testing import Harness
 
 import src.grafana_client as grafana_client
@@ -140,8 +150,8 @@ class BaseTestCharm(unittest.TestCase):
         self.harness.begin_with_initial_hooks()
         self.harness.container_pebble_ready("grafana")
 
-        self.minimal_datasource_hash = hashlib.sha256(
-            str(yaml.dump(MINIMAL_DATASOURCES_CONFIG)).encode("utf-8")
+        self.minimal_datasource_hash = hashlib.blake2b(
+            yaml.dump(MINIMAL_DATASOURCES_CONFIG).encode("utf-8"), digest_size=20
         ).hexdigest()
 
 
@@ -187,6 +197,144 @@ class TestCharm(BaseTestCharm):
             [{"name": "juju_test-model_abcdef_prometheus_0", "orgId": 1}],
         )
 
+    @patch.object(GrafanaCharm, "_generate_datasource_config")
+    def test_datasource_config_is_not_regenerated_when_inputs_are_unchanged(self, mock_generate):
+        mock_generate.return_value = yaml.dump(MINIMAL_DATASOURCES_CONFIG)
+        self.harness.set_leader(True)
+        self.harness.charm._last_rendered_datasource_inputs = None
+
+        self.harness.charm._check_datasource_provisioning()
+        self.harness.charm._check_datasource_provisioning()
+        self.assertEqual(mock_generate.call_count, 1)
+
+        self.harness.update_config({"datasource_query_timeout": 600})
+        self.harness.charm._check_datasource_provisioning()
+        self.assertEqual(mock_generate.call_count, 2)
+
+    @patch.object(GrafanaSourceConsumer, "sources_to_delete", new_callable=PropertyMock)
+    @patch.object(GrafanaSourceConsumer, "sources", new_callable=PropertyMock)
+    def test_datasource_config_does_not_depend_on_source_order(self, mock_sources, mock_delete):
+        sources = [
+            {"source_name": name, "source_type": "prometheus", "url": f"http://{name}:9090"}
+            for name in ("juju_a", "juju_b")
+        ]
+
+        mock_sources.return_value = sources
+        mock_delete.return_value = ["juju_c", "juju_d"]
+        config = self.harness.charm._generate_datasource_config()
+
+        mock_sources.return_value = list(reversed(sources))
+        mock_delete.return_value = ["juju_d", "juju_c"]
+        self.assertEqual(self.harness.charm._generate_datasource_config(), config)
+
+    @patch.object(GrafanaCharm, "_generate_grafana_config", return_value="")
+    def test_grafana_config_is_not_regenerated_when_inputs_are_unchanged(self, mock_generate):
+        self.harness.set_leader(True)
+        self.harness.charm._last_config_inputs = None
+
+        self.harness.charm._configure()
+        self.harness.charm._configure()
+        self.assertEqual(mock_generate.call_count, 1)
+
+        self.harness.update_config({"reporting_enabled": False})
+        self.assertEqual(mock_generate.call_count, 2)
+
+        # Datasource-only changes leave the base config alone
+        self.harness.update_config({"datasource_query_timeout": 600})
+        self.assertEqual(mock_generate.call_count, 2)
+
+    def test_resource_patch_is_only_queried_when_limits_change(self):
+        with patch.object(KubernetesComputeResourcesPatch, "is_ready", return_value=True) as mock:
+            self.harness.charm._resource_patch_ready_for = None
+            self.harness.charm._configure()
+            self.harness.charm._configure()
+            self.assertEqual(mock.call_count, 1)
+
+            self.harness.update_config({"cpu": "2"})
+            self.assertEqual(mock.call_count, 2)
+
+    def test_trusted_ca_certs_are_only_installed_once_per_change(self):
+        calls = []
+        self.harness.handle_exec(
+            "grafana", ["update-ca-certificates"], handler=lambda args: calls.append(args)
+        )
+        rel_id = self.harness.add_relation("receive-ca-cert", "ca")
+        self.harness.add_relation_unit(rel_id, "ca/0")
+        self.harness.update_relation_data(rel_id, "ca/0", {"ca": "first"})
+
+        calls.clear()
+        self.harness.charm._trusted_ca_certs = None
+        self.harness.charm._update_trusted_ca_certs()
+        self.harness.charm._update_trusted_ca_certs()
+        self.assertEqual(len(calls), 1)
+
+        calls.clear()
+        self.harness.update_relation_data(rel_id, "ca/0", {"ca": "second"})
+        self.harness.charm._update_trusted_ca_certs()
+        self.assertEqual(len(calls), 1)
+        cert_path = f"/usr/local/share/ca-certificates/trusted-ca-cert-{rel_id}-ca.crt"
+        container = self.harness.charm.containers["workload"]
+        self.assertEqual(container.pull(cert_path).read(), "second")
+
+    def test_removed_trusted_ca_is_dropped_from_the_trust_store(self):
+        calls = []
+        self.harness.handle_exec(
+            "grafana", ["update-ca-certificates"], handler=lambda args: calls.append(args)
+        )
+        rel_id = self.harness.add_relation("receive-ca-cert", "ca")
+        self.harness.add_relation_unit(rel_id, "ca/0")
+        self.harness.update_relation_data(rel_id, "ca/0", {"ca": "first"})
+        self.harness.charm._update_trusted_ca_certs()
+        cert_path = f"/usr/local/share/ca-certificates/trusted-ca-cert-{rel_id}-ca.crt"
+        container = self.harness.charm.containers["workload"]
+        self.assertTrue(container.exists(cert_path))
+
+        calls.clear()
+        self.harness.remove_relation(rel_id)
+        self.assertFalse(container.exists(cert_path))
+        self.assertEqual(len(calls), 1)
+
+    def test_removed_trusted_ca_rebuilds_the_trust_store_once_if_others_remain(self):
+        calls = []
+        self.harness.handle_exec(
+            "grafana", ["update-ca-certificates"], handler=lambda args: calls.append(args)
+        )
+        rel_ids = []
+        for app in ("ca", "other-ca"):
+            rel_id = self.harness.add_relation("receive-ca-cert", app)
+            self.harness.add_relation_unit(rel_id, f"{app}/0")
+            self.harness.update_relation_data(rel_id, f"{app}/0", {"ca": app})
+            rel_ids.append(rel_id)
+        self.harness.charm._update_trusted_ca_certs()
+
+        calls.clear()
+        self.harness.remove_relation(rel_ids[0])
+        container = self.harness.charm.containers["workload"]
+        ca_dir = "/usr/local/share/ca-certificates"
+        self.assertFalse(container.exists(f"{ca_dir}/trusted-ca-cert-{rel_ids[0]}-ca.crt"))
+        self.assertTrue(container.exists(f"{ca_dir}/trusted-ca-cert-{rel_ids[1]}-ca.crt"))
+        self.assertEqual(len(calls), 1)
+
+    @patch("subprocess.run")
+    def test_ca_is_only_installed_once_per_change(self, _):
+        calls = []
+        self.harness.handle_exec(
+            "grafana", ["update-ca-certificates"], handler=lambda args: calls.append(args)
+        )
+        with tempfile.TemporaryDirectory() as tmpdir, patch(
+            "src.charm.CA_CERT_PATH", Path(tmpdir) / "cos-ca.crt"
+        ), patch.object(CertHandler, "ca", new_callable=PropertyMock) as mock_ca:
+            mock_ca.return_value = "first"
+            self.harness.charm._update_cert()
+            self.harness.charm._update_cert()
+            self.assertEqual(len(calls), 1)
+
+            mock_ca.return_value = "second"
+            self.harness.charm._update_cert()
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(os.listdir(tmpdir), ["cos-ca.crt"])
+            self.assertEqual((Path(tmpdir) / "cos-ca.crt").read_text(), "second")
+
     def test_config_is_updated_with_database_relation(self):
         self.harness.set_leader(True)
 
@@ -201,6 +349,23 @@ class TestCharm(BaseTestCharm):
         config = self.harness.charm.containers["workload"].pull(CONFIG_PATH)
         self.assertEqual(config.read(), DATABASE_CONFIG_INI)
 
+    def test_unrelated_database_fields_do_not_regenerate_config(self):
+        self.harness.set_leader(True)
+
+        rel_id = self.harness.add_relation("database", "mysql")
+        self.harness.add_relation_unit(rel_id, "mysql/0")
+        self.harness.update_relation_data(rel_id, "mysql", DB_CONFIG)
+
+        charm = self.harness.charm
+        with patch.object(
+            GrafanaCharm, "_configure", autospec=True, side_effect=GrafanaCharm._configure
+        ) as mock_configure, patch.object(
+            GrafanaCharm, "_generate_grafana_config", wraps=charm._generate_grafana_config
+        ) as mock_generate:
+            self.harness.update_relation_data(rel_id, "mysql", {"unrelated": "value"})
+            mock_configure.assert_called()
+            mock_generate.assert_not_called()
+
     def test_dashboard_path_is_initialized(self):
         self.harness.set_leader(True)
 
@@ -210,6 +375,80 @@ class TestCharm(BaseTestCharm):
         config = self.harness.charm.containers["workload"].pull(dashboards_dir_path)
         self.assertEqual(yaml.safe_load(config), DASHBOARD_CONFIG)
 
+    @patch.object(GrafanaCharm, "restart_grafana")
+    def test_dashboard_provisioning_only_restarts_when_provider_config_changes(self, mock_restart):
+        self.harness.set_leader(True)
+
+        dashboards_dir_path = PROVISIONING_PATH + "/dashboards"
+
+        # Already provisioned on start-up
+        self.harness.charm.init_dashboard_provisioning(dashboards_dir_path)
+        mock_restart.assert_not_called()
+
+        self.harness.charm.containers["workload"].remove_path(
+            dashboards_dir_path + "/default.yaml"
+        )
+        self.harness.charm.init_dashboard_provisioning(dashboards_dir_path)
+        self.harness.charm.init_dashboard_provisioning(dashboards_dir_path)
+        self.assertEqual(mock_restart.call_count, 1)
+
+    @patch.object(GrafanaCharm, "_configure")
+    def test_dashboard_hooks_refresh_the_status(self, mock_configure):
+        self.harness.charm.dashboard_consumer.on.dashboards_changed.emit()
+        self.assertEqual(mock_configure.call_count, 1)
+
+        rel_id = self.harness.add_relation("metrics-endpoint", "prometheus")
+        self.harness.add_relation_unit(rel_id, "prometheus/0")
+        self.assertGreaterEqual(mock_configure.call_count, 2)
+
+    @patch.object(GrafanaCharm, "_configure")
+    def test_upgrade_configures_once(self, mock_configure):
+        self.harness.charm.on.upgrade_charm.emit()
+        self.assertEqual(mock_configure.call_count, 1)
+
+    @patch.object(GrafanaDashboardConsumer, "dashboards", new_callable=PropertyMock)
+    def test_dashboards_are_pushed_and_stale_ones_removed(self, mock_dashboards):
+        self.harness.set_leader(True)
+        container = self.harness.charm.containers["workload"]
+        dashboards_dir = PROVISIONING_PATH + "/dashboards"
+
+        mock_dashboards.return_value = [{"charm": "tester", "content": '{"title": "first"}'}]
+        self.harness.charm._update_dashboards(MagicMock())
+        first = [f.path for f in container.list_files(dashboards_dir, pattern="juju_*.json")]
+        self.assertEqual(len(first), 1)
+        self.assertEqual(container.pull(first[0]).read(), '{"title": "first"}')
+
+        mock_dashboards.return_value = [{"charm": "tester", "content": '{"title": "second"}'}]
+        self.harness.charm._update_dashboards(MagicMock())
+        second = [f.path for f in container.list_files(dashboards_dir, pattern="juju_*.json")]
+        self.assertEqual(len(second), 1)
+        self.assertNotEqual(first, second)
+        self.assertEqual(container.pull(second[0]).read(), '{"title": "second"}')
+
+        mock_dashboards.return_value = []
+        self.harness.charm._update_dashboards(MagicMock())
+        self.assertEqual(container.list_files(dashboards_dir, pattern="juju_*.json"), [])
+
+        # Once everything is cleaned up, there is no need to look at the directory again
+        with patch.object(ops.Container, "list_files") as mock_list_files:
+            self.harness.charm._update_dashboards(MagicMock())
+            mock_list_files.assert_not_called()
+
+    @patch.object(GrafanaCharm, "restart_grafana")
+    @patch.object(GrafanaDashboardConsumer, "dashboards", new_callable=PropertyMock)
+    def test_new_dashboards_are_picked_up_without_a_restart(self, mock_dashboards, mock_restart):
+        self.harness.set_leader(True)
+        container = self.harness.charm.containers["workload"]
+        dashboards_dir = PROVISIONING_PATH + "/dashboards"
+
+        mock_dashboards.return_value = [{"charm": "tester", "content": '{"title": "new"}'}]
+        self.harness.charm._on_dashboards_changed(MagicMock())
+
+        pushed = container.list_files(dashboards_dir, pattern="juju_*.json")
+        self.assertEqual(len(pushed), 1)
+        self.assertEqual(container.pull(pushed[0].path).read(), '{"title": "new"}')
+        mock_restart.assert_not_called()
+
     def test_can_get_password(self):
         self.harness.set_leader(True)
 
@@ -292,6 +531,20 @@ class TestCharm(BaseTestCharm):
             "http://grafana-k8s-0.testmodel.svc.cluster.local:3000",
         )
 
+    @patch.object(TraefikRouteRequirer, "submit_to_traefik")
+    def test_config_changed_writes_config_and_submits_ingress(self, mock_submit):
+        self.harness.set_leader(True)
+        self.harness.container_pebble_ready("grafana")
+        rel_id = self.harness.add_relation("ingress", "traefik")
+        self.harness.add_relation_unit(rel_id, "traefik/0")
+        mock_submit.reset_mock()
+
+        self.harness.update_config({"reporting_enabled": False})
+
+        config = self.harness.charm.containers["workload"].pull(CONFIG_PATH).read()
+        self.assertIn("reporting_enabled = false", config)
+        mock_submit.assert_called_once()
+
     @patch.object(grafana_client.Grafana, "build_info", new={"version": "1.0.0"})
     @patch.multiple("charm.TraefikRouteRequirer", external_host="1.2.3.4", scheme="http")
     def test_ingress_relation_sets_options_and_rel_data(self):
@@ -393,8 +646,8 @@ class TestCharmReplication(unittest.TestCase):
         self.harness.add_relation("grafana", "grafana-k8s")
         self.harness.set_leader(True)
 
-        self.minimal_datasource_hash = hashlib.sha256(
-            str(yaml.dump(MINIMAL_DATASOURCES_CONFIG)).encode("utf-8")
+        self.minimal_datasource_hash = hashlib.blake2b(
+            yaml.dump(MINIMAL_DATASOURCES_CONFIG).encode("utf-8"), digest_size=20
         ).hexdigest()
 
     @patch("socket.getfqdn", lambda: "1.2.3.4")
@@ -415,6 +668,7 @@ class TestCharmReplication(unittest.TestCase):
         replica_address = self.harness.charm.get_peer_data("replica_primary")
 
         self.assertEqual(unit_ip, replica_address)
+        self.assertEqual(self.harness.charm._fqdn, "1.2.3.4")
 
     @patch("socket.getfqdn", lambda: "2.3.4.5")
     def test_replicas_get_correct_environment_variables(self):
@@ -433,3 +687,4 @@ class TestCharmReplication(unittest.TestCase):
         ]["LITESTREAM_UPSTREAM_URL"]
 
         self.assertEqual(primary, "1.2.3.4:9876")
+        self.assertEqual(self.harness.charm._fqdn, "2.3.4.5")